@@ -1,19 +1,50 @@
 import argparse
 import sys
 import os
+import stat
 from datetime import datetime
 import collections
-import configparser
 import fnmatch
+from concurrent.futures import ThreadPoolExecutor
 
-from .repository import repo_find, repo_create
+from .repository import repo_find, repo_create, config_read
 from .objects import (
-    GitBlob, GitTree, GitCommit, GitTag, object_read, object_write,
-    object_find, object_resolve, kvlm_parse, kvlm_serialize,
-    tree_parse, tree_serialize, GitTreeLeaf
+    GitTree, GitCommit, object_read, object_write, object_hash,
+    blob_sha, object_find, object_resolve, kvlm_parse, kvlm_serialize,
+    tree_parse, tree_serialize, is_tree_mode, GitTreeLeaf
 )
 from .index import index_read, index_write, GitIndexEntry
-from .refs import ref_resolve, ref_list, show_ref, ref_create
+from .refs import ref_resolve, ref_iter, ref_create
+
+# Object type for each tree entry mode, keyed by its first three digits
+_MODE_TYPES = {
+    b'040': "tree",
+    b'100': "blob",
+    b'120': "blob",    # symlink
+    b'160': "commit",  # submodule
+}
+
+
+class _OutputBuffer:
+    """
+    Collects output and writes it to stdout in large chunks, for commands
+    that would otherwise print thousands of short lines.
+    """
+    def __init__(self, limit=64 * 1024):
+        self.limit = limit
+        self.parts = []
+        self.size = 0
+
+    def write(self, s):
+        self.parts.append(s)
+        self.size += len(s)
+        if self.size >= self.limit:
+            self.flush()
+
+    def flush(self):
+        sys.stdout.write("".join(self.parts))
+        self.parts = []
+        self.size = 0
 
 ##################################################
 # COMMANDS
@@ -38,27 +69,17 @@ def cmd_hash_object(args):
         repo = None
 
     with open(args.path, "rb") as f:
-        data = f.read()
-
-    # Choose constructor
-    fmt = args.type.encode()
-    if fmt == b'commit':
-        o = GitCommit(data)
-    elif fmt == b'tree':
-        o = GitTree(data)
-    elif fmt == b'tag':
-        o = GitTag(data)
-    else:
-        o = GitBlob(data)
-
-    sha = object_write(o, repo)
+        sha = object_hash(f, args.type.encode(), repo)
     print(sha)
 
 
 def cmd_show_ref(args):
     repo = repo_find()
-    refs = ref_list(repo)
-    show_ref(repo, refs, with_hash=True, prefix="refs")
+    out = _OutputBuffer()
+    for name, sha in ref_iter(repo):
+        if sha:  # a valid SHA
+            out.write(f"{sha} {name}\n")
+    out.flush()
 
 
 def cmd_rev_parse(args):
@@ -75,40 +96,36 @@ def cmd_ls_tree(args):
     repo = repo_find()
     tree_sha = object_find(repo, args.tree, fmt=b"tree")
     tree_obj = object_read(repo, tree_sha)
+    out = _OutputBuffer()
+
     def print_item(item, prefix=""):
         # Determine file mode
         mode = item.mode
         if len(mode) == 5:
-            # e.g. '100644'
-            # Take the first 2 digits for type detection
-            t = mode[:2]
+            # e.g. '40000', as written by git: pad to the 6-digit form
+            t = b'0' + mode[:2]
         else:
             t = mode[:3]
 
-        if t == b'040':
-            obj_type = "tree"
-        elif t == b'100':
-            obj_type = "blob"
-        elif t == b'120':
-            obj_type = "blob"  # symlink
-        elif t == b'160':
-            obj_type = "commit"  # submodule
-        else:
+        obj_type = _MODE_TYPES.get(t)
+        if obj_type is None:
             raise Exception(f"Weird mode {mode}")
 
-        print("{0} {1} {2}\t{3}".format(
-            mode.decode("ascii"), obj_type, item.sha, os.path.join(prefix, item.path)
-        ))
-
-    def recurse_tree(sha, prefix=""):
-        t_obj = object_read(repo, sha)
-        for leaf in t_obj.items:
-            if args.recursive and leaf.mode.startswith(b'04'):
-                recurse_tree(leaf.sha, os.path.join(prefix, leaf.path))
-            else:
-                print_item(leaf, prefix)
-
-    recurse_tree(tree_sha)
+        out.write(f"{mode.decode('ascii')} {obj_type} {item.sha}\t{os.path.join(prefix, item.path)}\n")
+
+    # Depth-first walk with an explicit stack of (items iterator, prefix)
+    stack = [(iter(tree_obj.items), "")]
+    while stack:
+        items, prefix = stack[-1]
+        leaf = next(items, None)
+        if leaf is None:
+            stack.pop()
+        elif args.recursive and is_tree_mode(leaf.mode):
+            subtree = object_read(repo, leaf.sha)
+            stack.append((iter(subtree.items), os.path.join(prefix, leaf.path)))
+        else:
+            print_item(leaf, prefix)
+    out.flush()
 
 
 def cmd_checkout(args):
@@ -130,20 +147,20 @@ def cmd_checkout(args):
     else:
         os.makedirs(dest_path)
 
-    def tree_checkout(tree_obj, path):
+    stack = [(obj, dest_path)]
+    while stack:
+        tree_obj, path = stack.pop()
         for item in tree_obj.items:
             f_obj = object_read(repo, item.sha)
             dest = os.path.join(path, item.path)
             if f_obj.fmt == b'tree':
                 os.mkdir(dest)
-                tree_checkout(f_obj, dest)
+                stack.append((f_obj, dest))
             elif f_obj.fmt == b'blob':
                 # For simplicity, ignoring symlinks
                 with open(dest, "wb") as fd:
                     fd.write(f_obj.blobdata)
 
-    tree_checkout(obj, dest_path)
-
 
 def cmd_rm(args):
     repo = repo_find()
@@ -151,38 +168,42 @@ def cmd_rm(args):
 
 
 def _rm(repo, paths, delete=True, skip_missing=False):
+    """Remove paths from the index; return the removed index entries."""
     idx = index_read(repo)
-    worktree = repo.worktree + os.sep
+    removed = _index_remove(repo, idx, paths, delete, skip_missing)
+    index_write(repo, idx)
+    return removed
 
-    abspaths = []
-    for p in paths:
-        ap = os.path.abspath(p)
-        if not ap.startswith(worktree):
-            raise Exception(f"Cannot remove path outside of worktree: {p}")
-        abspaths.append(ap)
+
+def _index_remove(repo, idx, paths, delete=True, skip_missing=False):
+    """Remove paths from the in-memory index idx; return the removed entries."""
+    # {index name -> absolute path}, so each entry is checked in O(1)
+    names = dict(_worktree_names(repo, paths, "Cannot remove path outside of worktree"))
 
     kept = []
     removed = []
 
     for e in idx.entries:
-        full_path = os.path.join(repo.worktree, e.name)
-        if full_path in abspaths:
-            removed.append(full_path)
+        if e.name in names:
+            removed.append(e)
         else:
             kept.append(e)
 
     # Check for missing paths
-    for p in abspaths:
-        if p not in removed and not skip_missing:
-            raise Exception(f"Cannot remove path not in index: {p}")
+    if not skip_missing and len(removed) < len(names):
+        found = {e.name for e in removed}
+        for name, ap in names.items():
+            if name not in found:
+                raise Exception(f"Cannot remove path not in index: {ap}")
 
     if delete:
-        for rm_path in removed:
+        for e in removed:
+            rm_path = names[e.name]
             if os.path.exists(rm_path):
                 os.unlink(rm_path)
 
     idx.entries = kept
-    index_write(repo, idx)
+    return removed
 
 
 def cmd_add(args):
@@ -192,26 +213,42 @@ def cmd_add(args):
 
 def _add(repo, paths, skip_missing=False):
     """Add files to the index (staging)."""
-    # First remove them from the index if present
-    _rm(repo, paths, delete=False, skip_missing=True)
-
     idx = index_read(repo)
-    worktree = repo.worktree + os.sep
 
-    for p in paths:
-        ap = os.path.abspath(p)
-        if not ap.startswith(worktree):
-            raise Exception(f"File outside of worktree: {p}")
-        if not os.path.isfile(ap):
+    # First remove them from the index if present, remembering the old
+    # entries so unchanged files don't need to be hashed again
+    old = {e.name: e for e in _index_remove(repo, idx, paths, delete=False, skip_missing=True)}
+
+    # Stat everything first and work out which files need hashing
+    todo = []
+    for p, (name, ap) in zip(paths, _worktree_names(repo, paths, "File outside of worktree")):
+        try:
+            stat_res = os.stat(ap)
+        except FileNotFoundError:
+            stat_res = None
+        if stat_res is None or not stat.S_ISREG(stat_res.st_mode):
             raise Exception(f"Not a file or does not exist: {p}")
 
-        with open(ap, "rb") as fd:
-            from .objects import GitBlob, object_write
-            blob_data = fd.read()
-            blob = GitBlob(blob_data)
-            sha = object_write(blob, repo)
+        old_entry = old.get(name)
+        if old_entry and _index_entry_unchanged(old_entry, stat_res):
+            sha = old_entry.sha
+        else:
+            sha = None
+        todo.append((ap, name, stat_res, sha))
+
+    # Hash and store the rest. hashlib and zlib release the GIL while they
+    # work, so a thread pool spreads this over all cores.
+    to_hash = [ap for ap, _, _, sha in todo if sha is None]
+    if len(to_hash) > 1:
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+            hashed = dict(zip(to_hash, ex.map(lambda ap: _add_blob(repo, ap), to_hash)))
+    else:
+        hashed = {ap: _add_blob(repo, ap) for ap in to_hash}
+
+    for ap, name, stat_res, sha in todo:
+        if sha is None:
+            sha = hashed[ap]
 
-        stat_res = os.stat(ap)
         ctime_s = int(stat_res.st_ctime)
         ctime_ns = stat_res.st_ctime_ns % 10**9
         mtime_s = int(stat_res.st_mtime)
@@ -230,43 +267,74 @@ def _add(repo, paths, skip_missing=False):
             sha=sha,
             flag_assume_valid=False,
             flag_stage=0,
-            name=os.path.relpath(ap, repo.worktree)
+            name=name
         )
         idx.entries.append(ie)
 
     index_write(repo, idx)
 
 
+def _worktree_names(repo, paths, error):
+    """
+    Map paths (relative to the cwd) to (index name, absolute path) pairs,
+    raising "<error>: <path>" for any path outside the worktree.
+    """
+    # os.path.abspath and relpath both call getcwd() on every use; do it once
+    cwd = os.getcwd()
+    prefix = os.path.realpath(repo.worktree) + os.sep
+    result = []
+    for p in paths:
+        ap = os.path.normpath(os.path.join(cwd, p))
+        if not ap.startswith(prefix):
+            raise Exception(f"{error}: {p}")
+        result.append((ap[len(prefix):], ap))
+    return result
+
+
+def _add_blob(repo, path):
+    """Store the file at path as a blob; return its sha."""
+    # object_hash maps the file instead of reading it into memory
+    with open(path, "rb") as fd:
+        return object_hash(fd, b'blob', repo)
+
+
 def cmd_log(args):
     repo = repo_find()
     start_sha = object_find(repo, args.commit, fmt=b"commit")
     seen = set()
 
-    print("digraph wyaglog{")
-    print(" node[shape=rect]")
-    _log_graphviz(repo, start_sha, seen)
-    print("}")
+    out = _OutputBuffer()
+    out.write("digraph wyaglog{\n")
+    out.write(" node[shape=rect]\n")
+    _log_graphviz(repo, start_sha, seen, out)
+    out.write("}\n")
+    out.flush()
 
 
-def _log_graphviz(repo, sha, seen):
-    if sha in seen:
-        return
-    seen.add(sha)
+def _log_graphviz(repo, sha, seen, out):
+    # Iterative, so long histories don't hit the recursion limit
+    stack = [sha]
+    while stack:
+        sha = stack.pop()
+        if sha in seen:
+            continue
+        seen.add(sha)
 
-    commit = object_read(repo, sha)
-    msg = commit.kvlm[None].decode("utf-8").strip().replace("\\","\\\\").replace("\"","\\\"")
-    if "\n" in msg:
-        msg = msg.split("\n",1)[0]
-    print(f" c_{sha} [label=\"{sha[:8]}: {msg}\"]")
+        commit = object_read(repo, sha)
+        msg = commit.kvlm[None].decode("utf-8").strip().replace("\\","\\\\").replace("\"","\\\"")
+        if "\n" in msg:
+            msg = msg.split("\n",1)[0]
+        out.write(f" c_{sha} [label=\"{sha[:8]}: {msg}\"]\n")
 
-    if b'parent' in commit.kvlm:
-        parents = commit.kvlm[b'parent']
-        if not isinstance(parents, list):
-            parents = [parents]
-        for p in parents:
-            parent_sha = p.decode("ascii")
-            print(f" c_{sha} -> c_{parent_sha};")
-            _log_graphviz(repo, parent_sha, seen)
+        if b'parent' in commit.kvlm:
+            parents = commit.kvlm[b'parent']
+            if not isinstance(parents, list):
+                parents = [parents]
+            parent_shas = [p.decode("ascii") for p in parents]
+            for parent_sha in parent_shas:
+                out.write(f" c_{sha} -> c_{parent_sha};\n")
+            # Reversed, so the first parent is visited first
+            stack.extend(reversed(parent_shas))
 
 
 def cmd_status(args):
@@ -280,16 +348,12 @@ def cmd_status(args):
 
 
 def _cmd_status_branch(repo):
-    head_path = repo.repo_file("HEAD")
-    with open(head_path, "r") as f:
-        head_content = f.read().strip()
-    if head_content.startswith("ref: refs/heads/"):
-        branch = head_content[16:]
+    head_ref, sha = repo.head()
+    if head_ref and head_ref.startswith("refs/heads/"):
+        branch = head_ref[11:]
         print(f"On branch {branch}")
     else:
         # detached HEAD
-        from .objects import object_find
-        sha = object_find(repo, "HEAD")
         print(f"Head detached at {sha}")
 
 
@@ -318,65 +382,110 @@ def _cmd_status_head_index(repo, idx):
 def _cmd_status_index_worktree(repo, idx):
     print("Changes not staged for commit:")
 
-    # Build a list of all files in the worktree
-    all_files = []
-    gitdir_prefix = repo.gitdir + os.sep
-
-    for root, dirs, files in os.walk(repo.worktree):
-        # skip .git folder
-        if root == repo.gitdir or root.startswith(gitdir_prefix):
-            continue
-        for f in files:
-            full_path = os.path.join(root, f)
-            rel_path = os.path.relpath(full_path, repo.worktree)
-            all_files.append(rel_path)
+    # Find all files in the worktree, keeping their stat results so we
+    # don't have to stat them again below
+    stats = _worktree_files(repo)
+    all_files = set(stats)
 
     # Compare index entries with actual files
     #  - If missing => "deleted"
-    #  - If timestamp changed => compare content => possibly "modified"
+    #  - If stat data matches the index => unchanged, like git we trust it
+    #  - If size changed => "modified", no need to read the file
+    #  - Otherwise compare content => possibly "modified"
     for e in idx.entries:
         full_path = os.path.join(repo.worktree, e.name)
-        if not os.path.exists(full_path):
+        st = stats.get(e.name)
+        if st is None:
             print(f" deleted: {e.name}")
         else:
-            st = os.stat(full_path)
-            ctime_ns = e.ctime[0]*10**9 + e.ctime[1]
-            mtime_ns = e.mtime[0]*10**9 + e.mtime[1]
-            if st.st_ctime_ns != ctime_ns or st.st_mtime_ns != mtime_ns:
-                # If changed, check contents
+            if _index_entry_unchanged(e, st):
+                pass
+            elif st.st_size & 0xFFFFFFFF != e.fsize:
+                print(f" modified: {e.name}")
+            else:
+                # Same size but different stat data: check contents
                 with open(full_path, "rb") as fd:
-                    from .objects import GitBlob, object_write
-                    new_data = fd.read()
-                    new_blob = GitBlob(new_data)
-                    new_sha = object_write(new_blob, None)  # Not storing in repo
-                    if new_sha != e.sha:
-                        print(f" modified: {e.name}")
-        if e.name in all_files:
-            all_files.remove(e.name)
+                    new_sha = blob_sha(fd.read())
+                if new_sha != e.sha:
+                    print(f" modified: {e.name}")
+        all_files.discard(e.name)
 
     print()
     print("Untracked files:")
     # the rest of all_files are untracked
     # ignoring .gitignore rules, or partial support is possible
-    for f in all_files:
+    for f in sorted(all_files):
         print(f"  {f}")
 
 
+def _index_entry_unchanged(e, st):
+    """
+    True if the stat result st matches what index entry e recorded, in
+    which case (like git) we trust the file hasn't changed.
+    """
+    ctime_ns = e.ctime[0]*10**9 + e.ctime[1]
+    mtime_ns = e.mtime[0]*10**9 + e.mtime[1]
+    # The index only stores the low 32 bits of size and inode
+    return (st.st_ctime_ns == ctime_ns and st.st_mtime_ns == mtime_ns
+            and st.st_size & 0xFFFFFFFF == e.fsize
+            and st.st_ino & 0xFFFFFFFF == e.ino)
+
+
+def _worktree_files(repo):
+    """
+    Walk the worktree (skipping .git) and return a dict of
+    {relative path -> os.stat_result} for every file in it. The stat result
+    is None for files that can't be stat'd, e.g. dangling symlinks.
+    Uses os.scandir so directory entries come with their type for free.
+    """
+    stats = {}
+    pending = [(repo.worktree, "")]
+    while pending:
+        path, rel = pending.pop()
+        try:
+            it = os.scandir(path)
+        except OSError:
+            # Like os.walk, skip directories we can't list (unreadable,
+            # or removed since we found them)
+            continue
+        with it:
+            for entry in it:
+                rel_path = rel + entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    # skip .git folder
+                    if entry.path != repo.gitdir:
+                        pending.append((entry.path, rel_path + os.sep))
+                elif not entry.is_dir():
+                    # Like os.walk, symlinks to directories are neither
+                    # files nor followed
+                    try:
+                        stats[rel_path] = entry.stat()
+                    except OSError:
+                        # Dangling symlink, or removed since we listed it
+                        stats[rel_path] = None
+    return stats
+
+
 def _tree_to_dict(repo, ref, prefix=""):
     """Return a dict of {path -> sha} for the tree corresponding to ref."""
     from .objects import object_find, object_read
     tree_sha = object_find(repo, ref, fmt=b"tree")
     if not tree_sha:
         return {}
-    t_obj = object_read(repo, tree_sha)
     result = {}
 
-    for leaf in t_obj.items:
+    # Depth-first walk with an explicit stack of (items iterator, prefix)
+    stack = [(iter(object_read(repo, tree_sha).items), prefix)]
+    while stack:
+        items, prefix = stack[-1]
+        leaf = next(items, None)
+        if leaf is None:
+            stack.pop()
+            continue
         full_path = os.path.join(prefix, leaf.path)
-        if leaf.mode.startswith(b'04'):
+        if is_tree_mode(leaf.mode):
             # It's a subtree
-            subtree = _tree_to_dict(repo, leaf.sha, full_path)
-            result.update(subtree)
+            stack.append((iter(object_read(repo, leaf.sha).items), full_path))
         else:
             result[full_path] = leaf.sha
     return result
@@ -388,7 +497,7 @@ def cmd_commit(args):
     tree_sha = _tree_from_index(repo, idx)
 
     # Build commit object
-    parent = object_find(repo, "HEAD", fmt=b"commit", follow=False)  # might be None if no HEAD
+    head_ref, parent = repo.head()  # parent is None on an unborn branch
     author = _gitconfig_user_get()
     timestamp = datetime.now()
     message = args.message if args.message else "Commit message"
@@ -396,17 +505,12 @@ def cmd_commit(args):
     new_commit_sha = _commit_create(repo, tree_sha, parent, author, timestamp, message)
 
     # Update HEAD (if on a branch)
-    head_path = repo.repo_file("HEAD")
-    with open(head_path, "r") as f:
-        head_content = f.read().strip()
-    if head_content.startswith("ref: "):
+    if head_ref:
         # It's referencing a branch
-        ref_path = head_content[5:]
-        ref_create(repo, ref_path, new_commit_sha)
+        ref_create(repo, head_ref, new_commit_sha)
     else:
         # Detached HEAD
-        with open(head_path, "w") as f:
-            f.write(new_commit_sha + "\n")
+        ref_create(repo, "HEAD", new_commit_sha)
 
 
 def _commit_create(repo, tree_sha, parent_sha, author, timestamp, message):
@@ -462,6 +566,12 @@ def _tree_from_index(repo, idx):
     # sorted by path length descending
     all_dirs = sorted(contents.keys(), key=lambda x: len(x), reverse=True)
 
+    # dict of {directory_path: [direct subdirectory paths]}
+    children_of = collections.defaultdict(list)
+    for c in contents:
+        if c != "":
+            children_of[os.path.dirname(c)].append(c)
+
     # dict of {directory_path: SHA}
     tree_map = {}
 
@@ -477,9 +587,7 @@ def _tree_from_index(repo, idx):
                 # If it's a subtree pointer like (name, sha), handle that
                 pass
         # Also, check if we have subtrees
-        # For each subdir in `contents` that is a direct child
-        child_dirs = [c for c in all_dirs if os.path.dirname(c) == d and c != d]
-        for cdir in child_dirs:
+        for cdir in children_of[d]:
             base = os.path.basename(cdir)
             sha = tree_map.get(cdir)
             if sha:
@@ -509,9 +617,8 @@ def _gitconfig_user_get():
         os.path.join(xdg_config_home, "git", "config"),
         os.path.expanduser("~/.gitconfig")
     ]
-    c = configparser.ConfigParser()
-    c.read(configfiles)
-    if "user" in c and "name" in c["user"] and "email" in c["user"]:
-        return f"{c['user']['name']} <{c['user']['email']}>"
+    user = config_read(*configfiles).get("user", {})
+    if "name" in user and "email" in user:
+        return f"{user['name']} <{user['email']}>"
     return "Wyag <wyag@example.com>"  # fallback
 
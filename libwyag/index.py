@@ -1,6 +1,7 @@
 import os
-from math import ceil
+import mmap
 import stat
+import struct
 from datetime import datetime
 
 from .repository import repo_find, GitRepository
@@ -14,6 +15,12 @@ class GitIndexEntry:
     Represents one entry in the Git index (staging area).
     Contains metadata (ctime, mtime, etc.) and a reference to a blob’s SHA.
     """
+    # An index holds one of these per tracked file, so skip the per-entry
+    # __dict__
+    __slots__ = ('ctime', 'mtime', 'dev', 'ino', 'mode_type', 'mode_perms',
+                 'uid', 'gid', 'fsize', 'sha', 'flag_assume_valid',
+                 'flag_stage', 'name')
+
     def __init__(self,
                  ctime=None, mtime=None,
                  dev=None, ino=None,
@@ -39,6 +46,8 @@ class GitIndexEntry:
 
 
 class GitIndex:
+    __slots__ = ('version', 'entries')
+
     def __init__(self, version=2, entries=None):
         self.version = version
         self.entries = entries if entries else []
@@ -48,65 +57,71 @@ class GitIndex:
 # READ / WRITE INDEX
 ##################################################
 
+# Fixed-size part of an index entry: ctime s/ns, mtime s/ns, dev, ino,
+# mode, uid, gid, size (all 32-bit), the raw 20-byte SHA, then 16 bits of
+# flags. The NUL-terminated name follows.
+_ENTRY = struct.Struct(">10I20sH")
+# Index header: signature, version, number of entries
+_HEADER = struct.Struct(">4sII")
+# Longest name we'll scan for when the 12-bit length field overflows
+_NAME_MAX = 64 * 1024
+
 def index_read(repo):
     """Read and parse the Git index file."""
     index_file = repo.repo_file("index")
     if not index_file or not os.path.exists(index_file):
         return GitIndex()
 
+    # Map the file and parse it in place instead of reading a copy
     with open(index_file, "rb") as f:
-        raw = f.read()
+        if os.fstat(f.fileno()).st_size < _HEADER.size:
+            raise Exception("Invalid index signature")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as raw:
+            return _index_parse(raw)
+
 
+def _index_parse(raw):
+    """Parse index data (bytes or an mmap) into a GitIndex."""
     # header
-    signature = raw[0:4]
+    signature, version, num_entries = _HEADER.unpack_from(raw, 0)
     if signature != b"DIRC":
         raise Exception("Invalid index signature")
-    version = int.from_bytes(raw[4:8], "big")
     if version != 2:
         raise Exception("Only index version 2 is supported.")
-    num_entries = int.from_bytes(raw[8:12], "big")
 
-    idx = 12
+    idx = _HEADER.size
     entries = []
 
     for _ in range(num_entries):
-        ctime_s = int.from_bytes(raw[idx: idx+4], "big")
-        ctime_ns = int.from_bytes(raw[idx+4: idx+8], "big")
-        mtime_s = int.from_bytes(raw[idx+8: idx+12], "big")
-        mtime_ns = int.from_bytes(raw[idx+12: idx+16], "big")
-        dev = int.from_bytes(raw[idx+16: idx+20], "big")
-        ino = int.from_bytes(raw[idx+20: idx+24], "big")
-        mode = int.from_bytes(raw[idx+24: idx+28], "big")
-        uid = int.from_bytes(raw[idx+28: idx+32], "big")
-        gid = int.from_bytes(raw[idx+32: idx+36], "big")
-        fsize = int.from_bytes(raw[idx+36: idx+40], "big")
-
-        # next 20 bytes => SHA
-        sha_val = int.from_bytes(raw[idx+40: idx+60], "big")
-        sha = f"{sha_val:040x}"
-
-        flags = int.from_bytes(raw[idx+60: idx+62], "big")
+        entry_start = idx
+        (ctime_s, ctime_ns, mtime_s, mtime_ns, dev, ino, mode, uid, gid,
+         fsize, sha_raw, flags) = _ENTRY.unpack_from(raw, idx)
+        sha = sha_raw.hex()
+
         flag_assume_valid = bool(flags & (0x1 << 15))
         flag_extended = bool(flags & (0x1 << 14))
         flag_stage = (flags >> 12) & 0x3
         name_len = flags & 0xfff
 
-        idx += 62
+        idx += _ENTRY.size
 
         if name_len < 0xfff:
             name_bytes = raw[idx: idx + name_len]
             idx += name_len
             idx += 1  # null terminator
         else:
-            # If name_len == 0xfff, we keep reading until null terminator
-            null_idx = raw.find(b'\x00', idx)
+            # If name_len == 0xfff, we keep reading until null terminator.
+            # Bound the scan so a corrupt entry can't walk the whole file.
+            null_idx = raw.find(b'\x00', idx, idx + _NAME_MAX)
+            if null_idx < 0:
+                raise Exception("Malformed index entry: unterminated name")
             name_bytes = raw[idx:null_idx]
             idx = null_idx + 1
 
         name = name_bytes.decode("utf-8")
 
-        # Align to multiple of 8
-        idx = 8 * ceil(idx / 8)
+        # Entries are padded to a multiple of 8 bytes
+        idx = entry_start + ((idx - entry_start + 7) & ~7)
 
         mode_type = (mode >> 12) & 0xF
         mode_perms = mode & 0xFFF
@@ -133,36 +148,27 @@ def index_read(repo):
 
 def index_write(repo, index):
     """Write the in-memory index back to .git/index."""
-    import struct
+    # Git requires entries sorted by name (then stage)
+    index.entries.sort(key=lambda e: (e.name, e.flag_stage))
+
+    # Size everything up front so the whole file goes into one zero-filled
+    # buffer. Each entry is the fixed part, the name and 1-8 NULs, padded
+    # to a multiple of 8 bytes.
+    names = [e.name.encode("utf-8") for e in index.entries]
+    size = _HEADER.size + sum((_ENTRY.size + len(n) + 8) & ~7 for n in names)
+    buf = bytearray(size)
 
     # Header: 12 bytes
     #  - signature (4 bytes): "DIRC"
     #  - version (4 bytes)
     #  - num_entries (4 bytes)
-    header = b"DIRC"
-    header += (index.version).to_bytes(4, "big")
-    header += (len(index.entries)).to_bytes(4, "big")
-
-    body = bytearray()
+    _HEADER.pack_into(buf, 0, b"DIRC", index.version, len(index.entries))
+    off = _HEADER.size
 
-    for e in index.entries:
+    for e, name_bytes in zip(index.entries, names):
         ctime_s, ctime_ns = e.ctime
         mtime_s, mtime_ns = e.mtime
-
-        body += ctime_s.to_bytes(4, "big")
-        body += ctime_ns.to_bytes(4, "big")
-        body += mtime_s.to_bytes(4, "big")
-        body += mtime_ns.to_bytes(4, "big")
-        body += e.dev.to_bytes(4, "big")
-        body += e.ino.to_bytes(4, "big")
-
         mode = ((e.mode_type & 0xF) << 12) | (e.mode_perms & 0xFFF)
-        body += mode.to_bytes(4, "big")
-
-        body += e.uid.to_bytes(4, "big")
-        body += e.gid.to_bytes(4, "big")
-        body += e.fsize.to_bytes(4, "big")
-        body += int(e.sha, 16).to_bytes(20, "big")
 
         flags = 0
         if e.flag_assume_valid:
@@ -171,24 +177,23 @@ def index_write(repo, index):
         # stage is bits 12-13
         flags |= (e.flag_stage & 0x3) << 12
 
-        name_bytes = e.name.encode("utf-8")
         nlen = len(name_bytes)
-        if nlen > 0xfff:
-            nlen = 0xfff
-        flags |= nlen
-
-        body += flags.to_bytes(2, "big")
-        body += name_bytes
-        body += b'\x00'
-
-        # Pad to multiple of 8
-        while len(body) % 8 != 0:
-            body += b'\x00'
+        flags |= min(nlen, 0xfff)
+
+        # Like git, keep only the low 32 bits of dev, ino, etc.
+        _ENTRY.pack_into(
+            buf, off,
+            ctime_s, ctime_ns, mtime_s, mtime_ns,
+            e.dev & 0xFFFFFFFF, e.ino & 0xFFFFFFFF, mode,
+            e.uid & 0xFFFFFFFF, e.gid & 0xFFFFFFFF, e.fsize & 0xFFFFFFFF,
+            bytes.fromhex(e.sha), flags)
+        name_off = off + _ENTRY.size
+        buf[name_off:name_off + nlen] = name_bytes
+        # The NUL terminator and padding are already zero
+        off += (_ENTRY.size + nlen + 8) & ~7
 
     # Real Git appends a trailing SHA-1 over all the data for integrity, but
     # we skip that for simplicity.
 
     with open(repo.repo_file("index"), "wb") as f:
-        f.write(header)
-        f.write(body)
-
+        f.write(buf)
@@ -1,11 +1,16 @@
 import os
+import stat
+import bisect
+import mmap
 import zlib
 import hashlib
 import collections
 import re
+import threading
 from math import ceil
 
 from .repository import repo_find, GitRepository
+from .refs import ref_resolve
 
 ##################################################
 # GIT OBJECTS
@@ -13,6 +18,7 @@ from .repository import repo_find, GitRepository
 
 class GitObject:
     """Base class for Git objects: commit, tree, tag, blob."""
+    __slots__ = ()
     fmt = None
 
     def __init__(self, data=None):
@@ -34,6 +40,7 @@ class GitObject:
 
 class GitBlob(GitObject):
     """A Git Blob object (stores file contents)."""
+    __slots__ = ('blobdata',)
     fmt = b'blob'
 
     def serialize(self):
@@ -45,6 +52,8 @@ class GitBlob(GitObject):
 
 class GitTreeLeaf:
     """A single entry in a tree object."""
+    __slots__ = ('mode', 'path', 'sha')
+
     def __init__(self, mode, path, sha):
         self.mode = mode      # e.g. b'100644', b'040000', ...
         self.path = path      # file or directory name
@@ -53,6 +62,7 @@ class GitTreeLeaf:
 
 class GitTree(GitObject):
     """A Git Tree object (directory listing)."""
+    __slots__ = ('items',)
     fmt = b'tree'
 
     def init(self):
@@ -67,6 +77,7 @@ class GitTree(GitObject):
 
 class GitCommit(GitObject):
     """A Git Commit object."""
+    __slots__ = ('kvlm',)
     fmt = b'commit'
 
     def init(self):
@@ -81,63 +92,217 @@ class GitCommit(GitObject):
 
 class GitTag(GitCommit):
     """A Git Tag object—same structure as a commit, but 'fmt = tag'."""
+    __slots__ = ()
     fmt = b'tag'
 
 
+# Object class for each type name found in object headers
+OBJECT_TYPES = {
+    b'commit': GitCommit,
+    b'tree': GitTree,
+    b'tag': GitTag,
+    b'blob': GitBlob,
+}
+
+
 ##################################################
 # OBJECT STORE: READ/WRITE/RESOLVE
 ##################################################
 
+# 4 to 40 hex characters: a full or abbreviated object name
+HASH_RE = re.compile(r"^[0-9A-Fa-f]{4,40}$")
+
+# Large payloads are fed to the hasher and compressor in blocks of this size.
+BLOCK_SIZE = 64 * 1024
+
+
+def sha1_new():
+    """
+    Return a new SHA-1 hasher. Object ids aren't a security use, so we ask
+    for the OpenSSL implementation without FIPS restrictions when we can.
+    """
+    try:
+        return hashlib.new("sha1", usedforsecurity=False)
+    except TypeError:  # Python < 3.9
+        return hashlib.new("sha1")
+
+
+def iter_blocks(data):
+    """Yield zero-copy BLOCK_SIZE slices of data."""
+    view = memoryview(data)
+    for i in range(0, len(view), BLOCK_SIZE):
+        yield view[i:i + BLOCK_SIZE]
+
+
+def loose_object_names(repo, subdir):
+    """
+    Return the sorted names of the loose objects in objects/<subdir>.
+    The listing is cached on the repo, so repeated short-hash lookups
+    bisect into it instead of listing the directory again.
+    """
+    names = repo._loose_objects.get(subdir)
+    if names is None:
+        obj_dir = repo.repo_dir("objects", subdir)
+        # Skip anything that isn't an object, e.g. a half-written temp file
+        names = sorted(n for n in os.listdir(obj_dir) if len(n) == 38) if obj_dir else []
+        repo._loose_objects[subdir] = names
+    return names
+
+
+# Recently read commits, trees and tags, keyed by object path (so by repo
+# and sha). Objects are immutable so entries never go stale. Blobs aren't
+# cached: they can be huge and are rarely read twice.
+OBJECT_CACHE_SIZE = 4096
+_object_cache = collections.OrderedDict()
+
+
+def _object_header(raw, sha):
+    """Split b"<type> <size>\\0" off raw, returning (type, size, null)."""
+    # The header is only a few bytes, so bound both scans to it.
+    null = raw.find(b'\x00', 0, 32)
+    space = raw.find(b' ', 0, null) if null > 0 else -1
+    if space < 0:
+        raise Exception(f"Malformed object {sha}: bad header")
+    return raw[:space], int(raw[space+1:null]), null
+
+
+def object_read_type(repo, sha):
+    """
+    Return the type of an object (e.g. b'blob') without reading it:
+    only as much is decompressed as the header needs.
+    """
+    path = repo.repo_file("objects", sha[0:2], sha[2:])
+    obj = _object_cache.get(path)
+    if obj is not None:
+        return obj.fmt
+    if not path or not os.path.isfile(path):
+        return None
+
+    d = zlib.decompressobj()
+    raw = b""
+    with open(path, "rb") as f:
+        while len(raw) < 32:
+            chunk = f.read(256)
+            if not chunk:
+                break
+            raw += d.decompress(chunk, 32 - len(raw))
+    return _object_header(raw, sha)[0]
+
+
 def object_read(repo, sha):
     """Read object from .git/objects/xx/xxxxxxxx...; return a GitObject."""
     path = repo.repo_file("objects", sha[0:2], sha[2:])
-    if not os.path.isfile(path):
+    obj = _object_cache.get(path)
+    if obj is not None:
+        _object_cache.move_to_end(path)
+        return obj
+    if not path or not os.path.isfile(path):
         return None
 
-    with open(path, "rb") as f:
-        raw = zlib.decompress(f.read())
+    # Decompress straight out of the page cache rather than reading the
+    # compressed bytes into a buffer first.
+    with open(path, "rb") as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        raw = zlib.decompress(mm)
 
     # raw = b"blob 14\0<file-contents>" or b"commit 177\0..."
-    space = raw.find(b' ')
-    obj_type = raw[:space]  # e.g. b'blob'
-    null = raw.find(b'\x00', space)
-    size = int(raw[space+1:null].decode("ascii"))
-    content = raw[null+1:]
+    obj_type, size, null = _object_header(raw, sha)
 
-    if size != len(content):
-        raise Exception(f"Malformed object {sha}: bad length (expected {size}, got {len(content)})")
+    if size != len(raw) - null - 1:
+        raise Exception(f"Malformed object {sha}: bad length (expected {size}, got {len(raw) - null - 1})")
 
     # Determine object type
-    if obj_type == b'commit':
-        c = GitCommit
-    elif obj_type == b'tree':
-        c = GitTree
-    elif obj_type == b'tag':
-        c = GitTag
-    elif obj_type == b'blob':
-        c = GitBlob
-    else:
+    c = OBJECT_TYPES.get(obj_type)
+    if c is None:
         raise Exception(f"Unknown type {obj_type.decode('ascii')} for object {sha}")
 
-    return c(content)
+    if c is GitBlob:
+        # Blob contents can be large: hand out a view rather than a copy
+        obj = c(memoryview(raw)[null+1:])
+    else:
+        obj = c(raw[null+1:])
+    if c is not GitBlob:
+        _object_cache[path] = obj
+        if len(_object_cache) > OBJECT_CACHE_SIZE:
+            _object_cache.popitem(last=False)
+    return obj
+
+
+# Guards the per-repo bookkeeping in object_write, which _add calls from
+# several threads at once.
+_write_lock = threading.Lock()
 
 
 def object_write(obj, repo=None):
     """Serialize and write object to repo, return the object's SHA-1."""
     data = obj.serialize()
-    # e.g. b'blob 14\0file content'
-    full = obj.fmt + b' ' + str(len(data)).encode() + b'\x00' + data
-    sha = hashlib.sha1(full).hexdigest()
-
-    if repo:
-        path = repo.repo_file("objects", sha[0:2], sha[2:], mkdir=True)
+    # e.g. b'blob 14\0' followed by the file content. Header and data are
+    # fed separately so we never build a second full copy of the object.
+    header = b"%s %d\x00" % (obj.fmt, len(data))
+    h = sha1_new()
+    h.update(header)
+    for block in iter_blocks(data):
+        h.update(block)
+    sha = h.hexdigest()
+
+    # Objects we know are on disk need neither a stat nor a write: this is
+    # what makes rewriting unchanged trees on every commit cheap.
+    if repo and sha not in repo._known_objects:
+        path = os.path.join(repo.repo_dir("objects", sha[0:2], mkdir=True), sha[2:])
         if not os.path.exists(path):
-            with open(path, "wb") as f:
-                f.write(zlib.compress(full))
+            # Write to a temp file first and rename it into place, so a
+            # crash never leaves a truncated object behind.
+            tmp_path = f"{path}.tmp{os.getpid()}.{threading.get_ident()}"
+            c = zlib.compressobj()
+            with open(tmp_path, "wb") as f:
+                f.write(c.compress(header))
+                for block in iter_blocks(data):
+                    f.write(c.compress(block))
+                f.write(c.flush())
+            os.replace(tmp_path, path)
+
+            with _write_lock:
+                names = repo._loose_objects.get(sha[0:2])
+                if names is not None:
+                    # Two threads may have just written the same object
+                    i = bisect.bisect_left(names, sha[2:])
+                    if i == len(names) or names[i] != sha[2:]:
+                        names.insert(i, sha[2:])
+                # A new object can make a cached short name ambiguous
+                repo._resolve_cache.clear()
+        repo._known_objects.add(sha)
 
     return sha
 
 
+def blob_sha(data):
+    """Return the SHA-1 data would have as a blob, without building a GitBlob."""
+    h = sha1_new()
+    h.update(b"blob %d\x00" % len(data))
+    for block in iter_blocks(data):
+        h.update(block)
+    return h.hexdigest()
+
+
+def object_hash(fd, fmt, repo=None):
+    """
+    Hash the contents of an open file as an object of type fmt, writing it
+    to repo if provided. Blobs are mmap'd rather than read, so hashing a
+    large file doesn't pull the whole thing into memory.
+    """
+    c = OBJECT_TYPES.get(fmt, GitBlob)
+    if c is not GitBlob:
+        return object_write(c(fd.read()), repo)
+
+    # Only non-empty regular files can be mapped; pipes, /proc files and
+    # the like report a size of 0 but still have contents to read.
+    st = os.fstat(fd.fileno())
+    if not (stat.S_ISREG(st.st_mode) and st.st_size > 0):
+        return object_write(GitBlob(fd.read()), repo)
+    with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return object_write(GitBlob(mm), repo)
+
+
 def object_resolve(repo, name):
     """
     Resolve a partial name (HEAD, short hash, tag, branch, etc.)
@@ -147,8 +312,7 @@ def object_resolve(repo, name):
     name = name.strip()
 
     if name == "HEAD":
-        from .refs import ref_resolve
-        head_sha = ref_resolve(repo, "HEAD")
+        head_sha = repo.head()[1]
         if head_sha:
             return [head_sha]
         else:
@@ -156,22 +320,26 @@ def object_resolve(repo, name):
 
     # Is it a full or partial hex?
     # e.g. 366e10f or f42a1b4...
-    # Regex to match 4 to 40 hex characters
-    hash_re = re.compile(r"^[0-9A-Fa-f]{4,40}$")
-    if hash_re.match(name):
+    if HASH_RE.match(name):
         name = name.lower()
         # Try to find an object in objects dir with this prefix
         # first two digits => subfolder
         subdir = name[:2]
         rest = name[2:]
-        obj_dir = repo.repo_dir("objects", subdir)
-        if obj_dir:
-            for filename in os.listdir(obj_dir):
-                if filename.startswith(rest):
-                    candidates.append(subdir + filename)
+        if len(rest) == 38:
+            # A full sha can only match itself: probe for the file rather
+            # than listing the whole directory.
+            if name in repo._known_objects or \
+                    os.path.isfile(repo.repo_path("objects", subdir, rest)):
+                candidates.append(name)
+        else:
+            names = loose_object_names(repo, subdir)
+            i = bisect.bisect_left(names, rest)
+            while i < len(names) and names[i].startswith(rest):
+                candidates.append(subdir + names[i])
+                i += 1
 
     # If it exactly matches a tag or branch
-    from .refs import ref_resolve
     tag_sha = ref_resolve(repo, "refs/tags/" + name)
     if tag_sha:
         candidates.append(tag_sha)
@@ -179,7 +347,7 @@ def object_resolve(repo, name):
     if branch_sha:
         candidates.append(branch_sha)
 
-    return list(set(candidates))  # remove duplicates, if any
+    return list(dict.fromkeys(candidates))  # remove duplicates, keeping order
 
 
 def object_find(repo, name, fmt=None, follow=True):
@@ -187,7 +355,17 @@ def object_find(repo, name, fmt=None, follow=True):
     Find and return the SHA-1 of an object in repo.
     If fmt is given, the object must match that type,
     or we follow tags if follow=True, etc.
+    Results are cached on the repo until a ref or object is written.
     """
+    key = (name, fmt, follow)
+    if key in repo._resolve_cache:
+        return repo._resolve_cache[key]
+    sha = _object_find(repo, name, fmt, follow)
+    repo._resolve_cache[key] = sha
+    return sha
+
+
+def _object_find(repo, name, fmt, follow):
     shalist = object_resolve(repo, name)
     if not shalist:
         raise Exception(f"No such reference {name}.")
@@ -201,19 +379,20 @@ def object_find(repo, name, fmt=None, follow=True):
         return sha
 
     while True:
-        obj = object_read(repo, sha)
-        if obj.fmt == fmt:
+        # Only the type is needed to decide; a blob is never decompressed
+        obj_type = object_read_type(repo, sha)
+        if obj_type == fmt:
             return sha
         if not follow:
             return None
-        if obj.fmt == b'tag':
+        if obj_type == b'tag':
             # A tag points to something else
-            kvlm = obj.kvlm  # the commit-style dict
+            kvlm = object_read(repo, sha).kvlm  # the commit-style dict
             # A tag object has an `object` field pointing to the actual object
             sha = kvlm[b'object'].decode("ascii")
-        elif obj.fmt == b'commit' and fmt == b'tree':
+        elif obj_type == b'commit' and fmt == b'tree':
             # A commit references a tree
-            sha = obj.kvlm[b'tree'].decode("ascii")
+            sha = object_read(repo, sha).kvlm[b'tree'].decode("ascii")
         else:
             return None
 
@@ -227,59 +406,68 @@ def kvlm_parse(raw, start=0, dct=None):
     if dct is None:
         dct = collections.OrderedDict()
 
-    # Search for space and newline
-    spc = raw.find(b' ', start)
-    nl = raw.find(b'\n', start)
-
-    # Base case: if newline comes first (or no spaces found)
-    # we assume this to be message
-    if (spc < 0) or (nl < spc):
-        # A blank line. The rest is the message
-        dct[None] = raw[start+1:]
-        return dct
-
-    # Read a key
-    key = raw[start:spc]
-
-    # Find the end of value
-    end = start
+    find = raw.find
+    space = ord(' ')
+    # One header line (plus its continuation lines) per iteration
     while True:
-        end = raw.find(b'\n', end+1)
-        # If next line doesn't start with a space, we found the end
-        if raw[end+1] != ord(' '):
-            break
-
-    # Value is all lines, minus leading space on continuation
-    value = raw[spc+1:end].replace(b'\n ', b'\n')
-
-    # Save in dict
-    if key in dct:
-        if isinstance(dct[key], list):
-            dct[key].append(value)
+        # Search for space and newline
+        spc = find(b' ', start)
+        nl = find(b'\n', start)
+
+        # If newline comes first (or no spaces found)
+        # we assume this to be message
+        if (spc < 0) or (nl < spc):
+            # A blank line. The rest is the message
+            dct[None] = raw[start+1:]
+            return dct
+
+        # Read a key
+        key = raw[start:spc]
+
+        # Find the end of value
+        end = start
+        while True:
+            end = find(b'\n', end+1)
+            # If next line doesn't start with a space, we found the end
+            if raw[end+1] != space:
+                break
+
+        # Value is all lines, minus leading space on continuation
+        value = raw[spc+1:end].replace(b'\n ', b'\n')
+
+        # Save in dict; repeated keys (e.g. parent) become a list
+        prev = dct.get(key)
+        if prev is None:
+            dct[key] = value
+        elif type(prev) is list:
+            prev.append(value)
         else:
-            dct[key] = [dct[key], value]
-    else:
-        dct[key] = value
+            dct[key] = [prev, value]
 
-    return kvlm_parse(raw, start=end+1, dct=dct)
+        start = end + 1
 
 
 def kvlm_serialize(kvlm):
     """Serialize a commit-like key-value list plus message."""
-    ret = b''
-    for k in kvlm.keys():
+    parts = []
+    append = parts.append
+    for k, val in kvlm.items():
         if k is None:
             continue
-        val = kvlm[k]
-        if not isinstance(val, list):
-            val = [val]
+        if type(val) is not list:
+            # Single values are stored unboxed
+            val = (val,)
         for v in val:
-            ret += k + b' ' + v.replace(b'\n', b'\n ') + b'\n'
+            append(k)
+            append(b' ')
+            append(v.replace(b'\n', b'\n '))
+            append(b'\n')
     # Append message
-    ret += b'\n'
-    if kvlm.get(None):
-        ret += kvlm[None]
-    return ret
+    append(b'\n')
+    msg = kvlm.get(None)
+    if msg:
+        append(msg)
+    return b''.join(parts)
 
 
 def tree_parse_one(raw, start=0):
@@ -299,42 +487,54 @@ def tree_parse_one(raw, start=0):
     path = raw[x+1:y]
 
     # Next 20 bytes are the SHA
-    sha_raw = raw[y+1:y+21]
-    sha_int = int.from_bytes(sha_raw, "big")
-    sha = f"{sha_int:040x}"
+    sha = raw[y+1:y+21].hex()
 
     return y+21, GitTreeLeaf(mode, path.decode("utf-8"), sha)
 
 
-def tree_parse(raw):
-    """Parse a tree raw data into a list of GitTreeLeaf objects."""
-    pos = 0
+def tree_scan(raw):
+    """
+    Locate every leaf in a tree's raw data, returning a list of
+    (mode_start, space, nul) offsets. The SHA is the 20 bytes after nul.
+    """
+    find = raw.find
     maxlen = len(raw)
-    items = []
+    offsets = []
+    pos = 0
     while pos < maxlen:
-        pos, leaf = tree_parse_one(raw, pos)
-        items.append(leaf)
-    return items
+        x = find(b' ', pos)
+        y = find(b'\x00', x)
+        offsets.append((pos, x, y))
+        pos = y + 21
+    return offsets
+
+
+def tree_parse(raw):
+    """Parse a tree raw data into a list of GitTreeLeaf objects."""
+    return [GitTreeLeaf(raw[start:x], raw[x+1:y].decode("utf-8"), raw[y+1:y+21].hex())
+            for start, x, y in tree_scan(raw)]
+
+
+def is_tree_mode(mode):
+    """True if a tree leaf's mode is a subtree's: git writes '40000', we '040000'."""
+    return mode in (b'40000', b'040000')
 
 
 def tree_serialize(tree_obj):
     """Serialize a GitTree object's items into raw bytes."""
-    # Sort by path, but place directories (mode '040000') before files
+    # Sort by path, comparing directories as if they ended in '/'
     # (mimicking Git’s sorting). This is simplistic: real Git has more rules.
-    def sort_key(leaf):
-        if leaf.mode.startswith(b'04'):
-            return leaf.path + '/'
-        return leaf.path
-
-    tree_obj.items.sort(key=sort_key)
-
-    ret = b''
-    for leaf in tree_obj.items:
-        ret += leaf.mode
-        ret += b' '
-        ret += leaf.path.encode("utf-8")
-        ret += b'\x00'
-        sha_int = int(leaf.sha, 16)
-        ret += sha_int.to_bytes(20, "big")
-    return ret
+    # Keys are built once up front so only directories pay for a
+    # concatenation.
+    items = tree_obj.items
+    keys = [leaf.path + '/' if is_tree_mode(leaf.mode) else leaf.path
+            for leaf in items]
+    items[:] = [items[i] for i in sorted(range(len(items)), key=keys.__getitem__)]
+
+    parts = []
+    extend = parts.extend
+    for leaf in items:
+        extend((leaf.mode, b' ', leaf.path.encode("utf-8"), b'\x00',
+                bytes.fromhex(leaf.sha)))
+    return b''.join(parts)
 
@@ -1,17 +1,25 @@
 import os
 import collections
+import functools
 
 from .repository import GitRepository
 
 def ref_resolve(repo, ref):
     """Follow a ref (e.g. 'HEAD' or 'refs/heads/master') until it resolves to a SHA-1."""
-    path = repo.repo_file(ref)
-    if not path or not os.path.isfile(path):
+    return _ref_resolve_cached(repo.gitdir, ref)
+
+
+@functools.lru_cache(maxsize=1024)
+def _ref_resolve_cached(gitdir, ref):
+    # Keyed on the gitdir string since GitRepository isn't hashable by
+    # value; cleared by ref_create whenever a ref changes.
+    path = os.path.join(gitdir, ref)
+    if not os.path.isfile(path):
         return None
     with open(path, "r") as f:
         data = f.read().strip()
     if data.startswith("ref: "):
-        return ref_resolve(repo, data[5:])
+        return _ref_resolve_cached(gitdir, data[5:])
     else:
         return data
 
@@ -21,6 +29,9 @@ def ref_create(repo, ref_name, sha):
     ref_path = repo.repo_file(ref_name, mkdir=True)
     with open(ref_path, "w") as f:
         f.write(sha + "\n")
+    _ref_resolve_cached.cache_clear()
+    repo._resolve_cache.clear()
+    repo._head = None
 
 
 def ref_list(repo, path=None):
@@ -41,6 +52,23 @@ def ref_list(repo, path=None):
     return refs
 
 
+def ref_iter(repo):
+    """
+    Yield (ref_name, sha) for every ref under refs/, sorted by full name
+    like git show-ref, without building the nested dicts of ref_list.
+    """
+    base = repo.repo_dir("refs")
+    if not base:
+        return
+    names = []
+    for root, dirs, files in os.walk(base):
+        rel = os.path.relpath(root, repo.gitdir)
+        names.extend(os.path.join(rel, name) for name in files)
+    names.sort()
+    for name in names:
+        yield name, ref_resolve(repo, name)
+
+
 def show_ref(repo, refs_dict, with_hash=True, prefix=""):
     """Recursive function to print refs (used by show-ref command)."""
     for name, val in refs_dict.items():
@@ -1,31 +1,144 @@
 # libwyag/repository.py
 import configparser
 import os
+import re
+
+# gitdir -> (parsed config, repositoryformatversion or None if not checked
+# yet), so opening the same repository again doesn't reparse its config.
+_config_cache = {}
+
+_SECTION_RE = re.compile(rb'^\s*\[([^\]]+)\]')
+_KV_RE = re.compile(rb'^\s*([A-Za-z0-9_.-]+)\s*=\s*(.*?)\s*$')
+
+
+def config_read(*paths):
+    """
+    Read git-style config files into {section: {key: value}}. Later files
+    override earlier ones and missing files are skipped, like
+    ConfigParser.read, but this is a lot cheaper than configparser for
+    the handful of keys we need.
+    """
+    conf = {}
+    for path in paths:
+        try:
+            with open(path, "rb") as f:
+                lines = f.read().splitlines()
+        except OSError:
+            continue
+        section = None
+        for line in lines:
+            m = _SECTION_RE.match(line)
+            if m:
+                section = conf.setdefault(m.group(1).strip().decode("utf-8"), {})
+                continue
+            m = _KV_RE.match(line)
+            if m and section is not None:
+                # Keys are case-insensitive, as in git (and configparser)
+                section[m.group(1).decode("utf-8").lower()] = m.group(2).decode("utf-8")
+    return conf
+
 
 class GitRepository:
     """A Git repository."""
+    # gitdir -> instance, so every open of the same repository shares one
+    # object and its caches. Forced opens (repo_create) bypass it.
+    _instances = {}
+
+    def __new__(cls, path, force=False):
+        repo = None if force else cls._instances.get(os.path.join(path, ".git"))
+        if repo is not None:
+            return repo
+        return super().__new__(cls)
+
     def __init__(self, path, force=False):
+        if hasattr(self, "gitdir"):
+            return  # cached instance handed back by __new__
         self.worktree = path
         self.gitdir = os.path.join(path, ".git")
-        self.conf = configparser.ConfigParser()
+        self.conf = {}
+        # Directories under gitdir we've already seen, so repeated
+        # lookups (e.g. objects/xx) don't stat them again.
+        self._known_dirs = set()
+        # objects/xx subdir -> sorted loose object names, filled lazily
+        self._loose_objects = {}
+        # Shas object_write has stored or found already stored
+        self._known_objects = set()
+        # (name, fmt, follow) -> sha, see object_find
+        self._resolve_cache = {}
+        # (ref, sha) for HEAD, see head()
+        self._head = None
+        # path components -> joined path, see repo_path
+        self._file_cache = {}
 
         if not (force or os.path.isdir(self.gitdir)):
             raise Exception(f"Not a Git Repository {path}")
 
-        cf = self.repo_file("config")
-        if cf and os.path.exists(cf):
-            self.conf.read([cf])
-        elif not force:
-            raise Exception("Configuration file missing")
+        cached = _config_cache.get(self.gitdir)
+        if cached:
+            self.conf, vers = cached
+        else:
+            vers = None
+            cf = self.repo_file("config")
+            if cf and os.path.exists(cf):
+                self.conf = config_read(cf)
+                _config_cache[self.gitdir] = (self.conf, vers)
+            elif not force:
+                raise Exception("Configuration file missing")
 
         if not force:
-            vers = int(self.conf.get("core", "repositoryformatversion"))
+            if vers is None:
+                vers = int(self.conf["core"]["repositoryformatversion"])
+                _config_cache[self.gitdir] = (self.conf, vers)
             if vers != 0:
                 raise Exception(f"Unsupported repositoryformatversion {vers}")
+            GitRepository._instances[self.gitdir] = self
+
+    @classmethod
+    def reload(cls, path=None):
+        """
+        Forget the cached instance and config for the repository at path
+        (or for every repository), so the next open reads it from disk.
+        """
+        if path is None:
+            cls._instances.clear()
+            _config_cache.clear()
+        else:
+            # Instances are keyed on the path they were opened with, and
+            # repo_find opens them by realpath: drop both spellings.
+            for worktree in {path, os.path.realpath(path)}:
+                gitdir = os.path.join(worktree, ".git")
+                cls._instances.pop(gitdir, None)
+                _config_cache.pop(gitdir, None)
+        # repo_find hands out the same instances
+        _repo_cache.clear()
+
+    def head(self):
+        """
+        Return (ref, sha) for HEAD: the ref it points to (None if HEAD is
+        detached) and the commit it resolves to (None on an unborn
+        branch). Cached until a ref is written.
+        """
+        if self._head is None:
+            from .refs import ref_resolve
+            with open(self.repo_file("HEAD"), "r") as f:
+                data = f.read().strip()
+            if data.startswith("ref: "):
+                ref = data[5:]
+                self._head = (ref, ref_resolve(self, ref))
+            else:
+                self._head = (None, data)
+        return self._head
 
     def repo_path(self, *path):
         """Compute path under repo's gitdir."""
-        return os.path.join(self.gitdir, *path)
+        # Object paths (objects/xx/yyy...) are one per object, so only the
+        # shorter, constantly reused ones (HEAD, index, refs) are cached.
+        if len(path) > 2:
+            return os.path.join(self.gitdir, *path)
+        full = self._file_cache.get(path)
+        if full is None:
+            full = self._file_cache[path] = os.path.join(self.gitdir, *path)
+        return full
 
     def repo_file(self, *path, mkdir=False):
         if self.repo_dir(*path[:-1], mkdir=mkdir):
@@ -34,14 +147,27 @@ class GitRepository:
 
     def repo_dir(self, *path, mkdir=False):
         path = self.repo_path(*path)
-        if os.path.exists(path):
-            if os.path.isdir(path):
-                return path
-            else:
-                raise Exception(f"Not a directory {path}")
+        if path in self._known_dirs:
+            return path
+        if os.path.isdir(path):
+            self._known_dirs.add(path)
+            return path
         if mkdir:
-            os.makedirs(path)
+            # Just try to create it instead of probing first; usually
+            # only the last component is missing (e.g. objects/xx)
+            try:
+                os.mkdir(path)
+            except FileExistsError:
+                # Another thread (see _add) may have created it since we
+                # probed; only a non-directory in the way is an error.
+                if not os.path.isdir(path):
+                    raise Exception(f"Not a directory {path}")
+            except FileNotFoundError:
+                os.makedirs(path, exist_ok=True)
+            self._known_dirs.add(path)
             return path
+        if os.path.exists(path):
+            raise Exception(f"Not a directory {path}")
         return None
 
 
@@ -50,6 +176,11 @@ def repo_create(path):
     from .repository import GitRepository  # or a relative import
     repo = GitRepository(path, force=True)
 
+    # Cached lookups may point at whatever used to be here
+    GitRepository.reload(path)
+    from .refs import _ref_resolve_cached
+    _ref_resolve_cached.cache_clear()
+
     if os.path.exists(repo.worktree):
         if not os.path.isdir(repo.worktree):
             raise Exception(f"{path} is not a directory!")
@@ -89,19 +220,35 @@ def repo_default_config():
     return c
 
 
-def repo_find(path=".", required=True):
-    """Find a repo, searching up the directory hierarchy until .git is found."""
-    path = os.path.realpath(path)
-    if os.path.isdir(os.path.join(path, ".git")):
-        return GitRepository(path)
-
-    parent = os.path.realpath(os.path.join(path, ".."))
-    if parent == path:
-        # If parent==path, then path is root
-        if required:
-            raise Exception("No git directory.")
-        else:
-            return None
+# realpath -> GitRepository found from it, for every directory repo_find
+# has walked through, so later lookups from anywhere in the worktree are a
+# dict hit.
+_repo_cache = {}
 
-    return repo_find(parent, required)
 
+def repo_find(path=".", required=True):
+    """Find a repo, searching up the directory hierarchy until .git is found."""
+    # Resolve symlinks once, up front. getcwd() is already canonical, so
+    # the common "." case skips realpath's per-component lstat calls.
+    path = os.getcwd() if path == "." else os.path.realpath(path)
+    visited = []
+    while True:
+        repo = _repo_cache.get(path)
+        if repo is None and os.path.isdir(os.path.join(path, ".git")):
+            repo = GitRepository(path)
+        if repo is not None:
+            _repo_cache[path] = repo
+            for p in visited:
+                _repo_cache[p] = repo
+            return repo
+        visited.append(path)
+
+        # path is already canonical, so going up is a pure string op
+        parent = os.path.dirname(path)
+        if parent == path:
+            # If parent==path, then path is root
+            if required:
+                raise Exception("No git directory.")
+            else:
+                return None
+        path = parent